@@ -1,11 +1,20 @@
 import asyncio
+import functools
 import logging
 import os
+import re
+import ssl
+import time
 import aiosqlite
 import aiohttp
+from collections import namedtuple
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types, F, Router
-from aiogram.filters import Command, CommandStart
+from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+)
+from aiogram.filters import BaseFilter, Command, CommandStart, StateFilter
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
@@ -20,17 +29,51 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN")
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x)
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "@support")
 SHOP_NAME = os.getenv("SHOP_NAME", "Digital Shop")
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+
+
+class IsAdmin(BaseFilter):
+    async def __call__(self, event) -> bool:
+        return event.from_user.id in ADMIN_IDS
+
+
+# Admin handlers live on their own router guarded once at dispatch, instead of
+# each handler re-checking ADMIN_IDS; it is included first so admin callbacks
+# are matched before the shared router.
+admin_router = Router()
+admin_router.message.filter(IsAdmin())
+admin_router.callback_query.filter(IsAdmin())
 router = Router()
+dp.include_router(admin_router)
 dp.include_router(router)
 
 DB_PATH = "shop.db"
+DB = None  # set in init_db(), closed in main()
+DB_LOCK = asyncio.Lock()  # serializes write transactions on the shared connection
+
+BROADCAST_CONCURRENCY = 20  # concurrent sockets during a broadcast
+BROADCAST_RATE = 30  # messages per second, Telegram's global cap
+
+PAYMENT_POLL_INTERVAL = 15  # seconds between CryptoBot pending-invoice sweeps
+
+BOT_USERNAME = None  # cached in main() to avoid a getMe round-trip per invoice
+
+SSL_CTX = ssl.create_default_context()
+HTTP = None  # shared aiohttp session for CryptoBot, created in main()
+
+
+async def open_http():
+    global HTTP
+    HTTP = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(ssl=SSL_CTX, limit=50, ttl_dns_cache=300),
+        headers={"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
+    )
 
 
 # ==================== FSM States ====================
@@ -54,23 +97,69 @@ class UserStates(StatesGroup):
     waiting_payment = State()
 
 
+# ==================== Row types ====================
+# Lightweight namedtuples instead of aiosqlite.Row: attribute access is O(1),
+# while Row.__getitem__ scans the column names on every field access.
+User = namedtuple('User', 'user_id username first_name balance total_purchases total_spent registered_at blocked_at')
+Product = namedtuple('Product', 'id category_id name description price product_type content file_id is_active created_at')
+Purchase = namedtuple('Purchase', 'id user_id product_id price purchased_at product_name')
+Payment = namedtuple('Payment', 'id user_id product_id invoice_id amount status created_at')
+Media = namedtuple('Media', 'key media_type file_id')
+
+
+# ==================== Read cache ====================
+CACHE_TTL = 300  # seconds; admin writes invalidate explicitly
+_cache = {}  # key -> (expires_at, value)
+
+
+def _cache_get(key):
+    entry = _cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry
+    return None
+
+
+def _cache_put(key, value):
+    _cache[key] = (time.monotonic() + CACHE_TTL, value)
+    return value
+
+
+def _cache_drop(key):
+    _cache.pop(key, None)
+
+
 # ==================== Database ====================
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''CREATE TABLE IF NOT EXISTS users (
+    global DB
+    DB = await aiosqlite.connect(DB_PATH)
+    DB.row_factory = aiosqlite.Row
+    # page_size only takes effect before the first table is created (or after a
+    # VACUUM) and must precede the switch to WAL
+    await DB.execute('PRAGMA page_size=4096')
+    await DB.execute('PRAGMA journal_mode=WAL')
+    await DB.execute('PRAGMA synchronous=NORMAL')
+    await DB.execute('PRAGMA temp_store=memory')
+    await DB.execute('PRAGMA cache_size=-64000')
+    await DB.execute('PRAGMA mmap_size=268435456')
+    await DB.execute('''CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             balance REAL DEFAULT 0,
             total_purchases INTEGER DEFAULT 0,
             total_spent REAL DEFAULT 0,
-            registered_at TEXT
+            registered_at TEXT,
+            blocked_at TEXT
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS categories (
+    try:
+        await DB.execute('ALTER TABLE users ADD COLUMN blocked_at TEXT')
+    except aiosqlite.OperationalError:
+        pass  # column already exists on databases created before it was added
+    await DB.execute('''CREATE TABLE IF NOT EXISTS categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS products (
+    await DB.execute('''CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             category_id INTEGER,
             name TEXT NOT NULL,
@@ -83,7 +172,7 @@ async def init_db():
             created_at TEXT,
             FOREIGN KEY (category_id) REFERENCES categories(id)
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS purchases (
+    await DB.execute('''CREATE TABLE IF NOT EXISTS purchases (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             product_id INTEGER,
@@ -92,16 +181,16 @@ async def init_db():
             FOREIGN KEY (user_id) REFERENCES users(user_id),
             FOREIGN KEY (product_id) REFERENCES products(id)
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS media_settings (
+    await DB.execute('''CREATE TABLE IF NOT EXISTS media_settings (
             key TEXT PRIMARY KEY,
             media_type TEXT,
             file_id TEXT
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS shop_settings (
+    await DB.execute('''CREATE TABLE IF NOT EXISTS shop_settings (
             key TEXT PRIMARY KEY,
             value TEXT
         )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS payments (
+    await DB.execute('''CREATE TABLE IF NOT EXISTS payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             product_id INTEGER,
@@ -110,207 +199,276 @@ async def init_db():
             status TEXT DEFAULT 'pending',
             created_at TEXT
         )''')
-        await db.commit()
+    await DB.execute('CREATE INDEX IF NOT EXISTS idx_products_cat_active ON products(category_id) WHERE is_active = 1')
+    await DB.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, purchased_at DESC)')
+    await DB.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_invoice ON payments(invoice_id)')
+    await DB.execute('''CREATE TRIGGER IF NOT EXISTS trg_purchase AFTER INSERT ON purchases BEGIN
+            UPDATE users SET total_purchases = total_purchases + 1,
+                total_spent = total_spent + NEW.price WHERE user_id = NEW.user_id;
+        END''')
+    await DB.commit()
 
 
 async def add_user(user: types.User):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''INSERT OR IGNORE INTO users (user_id, username, first_name, registered_at)
+    async with DB_LOCK:
+        await DB.execute('''INSERT OR IGNORE INTO users (user_id, username, first_name, registered_at)
             VALUES (?, ?, ?, ?)''', (user.id, user.username, user.first_name, datetime.now().isoformat()))
-        await db.commit()
+        # anyone who reaches /start has unblocked the bot
+        await DB.execute('UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL',
+                         (user.id,))
+        await DB.commit()
+
+
+async def fetch_one(sql: str, args=()):
+    rows = await DB.execute_fetchall(sql, args)
+    return rows[0] if rows else None
 
 
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            return await cursor.fetchone()
+    row = await fetch_one('SELECT * FROM users WHERE user_id = ?', (user_id,))
+    return User(*row) if row else None
 
 
 async def get_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT COUNT(*) FROM users') as cursor:
-            users_count = (await cursor.fetchone())[0]
-        async with db.execute('SELECT COUNT(*) FROM purchases') as cursor:
-            purchases_count = (await cursor.fetchone())[0]
-        async with db.execute('SELECT COALESCE(SUM(price), 0) FROM purchases') as cursor:
-            total_revenue = (await cursor.fetchone())[0]
-        async with db.execute('SELECT COUNT(*) FROM products WHERE is_active = 1') as cursor:
-            products_count = (await cursor.fetchone())[0]
-    return users_count, purchases_count, total_revenue, products_count
+    row = await fetch_one('''SELECT
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM purchases),
+        (SELECT COALESCE(SUM(price), 0) FROM purchases),
+        (SELECT COUNT(*) FROM products WHERE is_active = 1)''')
+    return row[0], row[1], row[2], row[3]
 
 
 async def get_categories():
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM categories') as cursor:
-            return await cursor.fetchall()
+    hit = _cache_get('categories')
+    if hit:
+        return hit[1]
+    return _cache_put('categories', await DB.execute_fetchall('SELECT * FROM categories'))
 
 
 async def add_category(name: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('INSERT INTO categories (name) VALUES (?)', (name,))
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute('INSERT INTO categories (name) VALUES (?)', (name,))
+        await DB.commit()
+    _cache_drop('categories')
 
 
 async def delete_category(cat_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('DELETE FROM products WHERE category_id = ?', (cat_id,))
-        await db.execute('DELETE FROM categories WHERE id = ?', (cat_id,))
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute('DELETE FROM products WHERE category_id = ?', (cat_id,))
+        await DB.execute('DELETE FROM categories WHERE id = ?', (cat_id,))
+        await DB.commit()
+    _cache.clear()  # cached products of this category are gone too
 
 
 async def get_products_by_category(category_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM products WHERE category_id = ? AND is_active = 1',
-                              (category_id,)) as cursor:
-            return await cursor.fetchall()
+    rows = await DB.execute_fetchall('SELECT * FROM products WHERE category_id = ? AND is_active = 1',
+                                     (category_id,))
+    return [Product(*row) for row in rows]
 
 
 async def get_product(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM products WHERE id = ?', (product_id,)) as cursor:
-            return await cursor.fetchone()
+    hit = _cache_get(('product', product_id))
+    if hit:
+        return hit[1]
+    row = await fetch_one('SELECT * FROM products WHERE id = ?', (product_id,))
+    return _cache_put(('product', product_id), Product(*row) if row else None)
 
 
 async def add_product(category_id, name, description, price, product_type, content=None, file_id=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''INSERT INTO products (category_id, name, description, price, product_type, content, file_id, created_at)
+    async with DB_LOCK:
+        await DB.execute('''INSERT INTO products (category_id, name, description, price, product_type, content, file_id, created_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
                          (category_id, name, description, price, product_type, content, file_id,
                           datetime.now().isoformat()))
-        await db.commit()
+        await DB.commit()
+
+
+async def bulk_add_products(rows):
+    """Insert many (category_id, name, description, price, product_type, content, file_id,
+    created_at) tuples in one transaction. Import/seed flows must use this, not
+    add_product() per row."""
+    async with DB_LOCK:
+        await DB.executemany('''INSERT INTO products (category_id, name, description, price, product_type, content, file_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        await DB.commit()
+
+
+async def bulk_add_users(rows):
+    """Insert many (user_id, username, first_name, registered_at) tuples in one transaction."""
+    async with DB_LOCK:
+        await DB.executemany('''INSERT OR IGNORE INTO users (user_id, username, first_name, registered_at)
+            VALUES (?, ?, ?, ?)''', rows)
+        await DB.commit()
 
 
 async def delete_product(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('UPDATE products SET is_active = 0 WHERE id = ?', (product_id,))
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute('UPDATE products SET is_active = 0 WHERE id = ?', (product_id,))
+        await DB.commit()
+    _cache_drop(('product', product_id))
 
 
 async def add_purchase(user_id: int, product_id: int, price: float):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''INSERT INTO purchases (user_id, product_id, price, purchased_at)
+    # trg_purchase bumps the user's counters in the same statement
+    async with DB_LOCK:
+        await DB.execute('''INSERT INTO purchases (user_id, product_id, price, purchased_at)
             VALUES (?, ?, ?, ?)''', (user_id, product_id, price, datetime.now().isoformat()))
-        await db.execute('''UPDATE users SET total_purchases = total_purchases + 1, 
-            total_spent = total_spent + ? WHERE user_id = ?''', (price, user_id))
-        await db.commit()
+        await DB.commit()
 
 
 async def get_user_purchases(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('''SELECT p.*, pr.name as product_name FROM purchases p 
-            JOIN products pr ON p.product_id = pr.id WHERE p.user_id = ? ORDER BY p.purchased_at DESC LIMIT 10''',
-                              (user_id,)) as cursor:
-            return await cursor.fetchall()
+    rows = await DB.execute_fetchall('''SELECT p.*, pr.name as product_name FROM purchases p 
+        JOIN products pr ON p.product_id = pr.id WHERE p.user_id = ? ORDER BY p.purchased_at DESC LIMIT 10''',
+                                     (user_id,))
+    return [Purchase(*row) for row in rows]
 
 
 async def set_media(key: str, media_type: str, file_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('INSERT OR REPLACE INTO media_settings (key, media_type, file_id) VALUES (?, ?, ?)',
+    async with DB_LOCK:
+        await DB.execute('INSERT OR REPLACE INTO media_settings (key, media_type, file_id) VALUES (?, ?, ?)',
                          (key, media_type, file_id))
-        await db.commit()
+        await DB.commit()
+    _cache_drop(('media', key))
 
 
 async def get_media(key: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM media_settings WHERE key = ?', (key,)) as cursor:
-            return await cursor.fetchone()
+    hit = _cache_get(('media', key))
+    if hit:
+        return hit[1]
+    row = await fetch_one('SELECT * FROM media_settings WHERE key = ?', (key,))
+    return _cache_put(('media', key), Media(*row) if row else None)
 
 
 async def get_shop_setting(key: str, default: str = ""):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT value FROM shop_settings WHERE key = ?', (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else default
+    hit = _cache_get(('shop_setting', key))
+    if hit:
+        row = hit[1]
+    else:
+        row = _cache_put(('shop_setting', key),
+                         await fetch_one('SELECT value FROM shop_settings WHERE key = ?', (key,)))
+    return row[0] if row else default
 
 
 async def set_shop_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('INSERT OR REPLACE INTO shop_settings (key, value) VALUES (?, ?)', (key, value))
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute('INSERT OR REPLACE INTO shop_settings (key, value) VALUES (?, ?)', (key, value))
+        await DB.commit()
+    _cache_drop(('shop_setting', key))
 
 
 async def save_payment(user_id: int, product_id: int, invoice_id: str, amount: float):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''INSERT INTO payments (user_id, product_id, invoice_id, amount, created_at)
+    async with DB_LOCK:
+        await DB.execute('''INSERT INTO payments (user_id, product_id, invoice_id, amount, created_at)
             VALUES (?, ?, ?, ?, ?)''', (user_id, product_id, invoice_id, amount, datetime.now().isoformat()))
-        await db.commit()
+        await DB.commit()
 
 
-async def update_payment_status(invoice_id: str, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('UPDATE payments SET status = ? WHERE invoice_id = ?', (status, invoice_id))
-        await db.commit()
+async def claim_pending_payment(invoice_id: str):
+    # Atomic check-and-flip: with both the poller and the check button able to
+    # finalize an invoice, only the caller whose UPDATE changes the row may
+    # deliver the product
+    async with DB_LOCK:
+        cursor = await DB.execute(
+            "UPDATE payments SET status = 'paid' WHERE invoice_id = ? AND status = 'pending'",
+            (invoice_id,))
+        await DB.commit()
+        return cursor.rowcount == 1
 
 
 async def get_payment(invoice_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM payments WHERE invoice_id = ?', (invoice_id,)) as cursor:
-            return await cursor.fetchone()
+    row = await fetch_one('SELECT * FROM payments WHERE invoice_id = ?', (invoice_id,))
+    return Payment(*row) if row else None
+
+
+async def iter_all_users():
+    # Broadcast recipients: users who blocked the bot only cost a 403, so the
+    # query filters them out up front
+    async with DB.execute('SELECT user_id FROM users WHERE blocked_at IS NULL') as cursor:
+        async for row in cursor:
+            yield row[0]
 
 
-async def get_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT user_id FROM users') as cursor:
-            return [row[0] for row in await cursor.fetchall()]
+async def mark_blocked(user_id: int):
+    async with DB_LOCK:
+        await DB.execute('UPDATE users SET blocked_at = ? WHERE user_id = ?',
+                         (datetime.now().isoformat(), user_id))
+        await DB.commit()
 
 
 # ==================== CryptoBot API ====================
 async def create_invoice(amount: float, description: str, payload: str):
     url = "https://pay.crypt.bot/api/createInvoice"
-    headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
     data = {
         "asset": "USDT",
         "amount": str(amount),
         "description": description,
         "payload": payload,
         "paid_btn_name": "callback",
-        "paid_btn_url": f"https://t.me/{(await bot.get_me()).username}"
+        "paid_btn_url": f"https://t.me/{BOT_USERNAME}"
     }
-    import ssl
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async with session.post(url, headers=headers, json=data) as resp:
-            result = await resp.json()
-            if result.get("ok"):
-                return result["result"]
+    async with HTTP.post(url, json=data) as resp:
+        result = await resp.json()
+        if result.get("ok"):
+            return result["result"]
     return None
 
 
 async def check_invoice(invoice_id: str):
     url = "https://pay.crypt.bot/api/getInvoices"
-    headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
     params = {"invoice_ids": invoice_id}
-    import ssl
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async with session.get(url, headers=headers, params=params) as resp:
-            result = await resp.json()
-            if result.get("ok") and result["result"]["items"]:
-                return result["result"]["items"][0]
+    async with HTTP.get(url, params=params) as resp:
+        result = await resp.json()
+        if result.get("ok") and result["result"]["items"]:
+            return result["result"]["items"][0]
     return None
 
 
 # ==================== Keyboards ====================
+# Static keyboards are built once at import: every construction runs Pydantic
+# validation over the markup and all its buttons.
+MAIN_KB = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="🛒 Купить"), KeyboardButton(text="👤 Мой профиль")],
+    [KeyboardButton(text="🏬 О шопе"), KeyboardButton(text="🛟 Поддержка")]
+], resize_keyboard=True)
+
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+    [InlineKeyboardButton(text="🖼 Медиа", callback_data="admin_media")],
+    [InlineKeyboardButton(text="📨 Рассылка", callback_data="admin_broadcast")],
+    [InlineKeyboardButton(text="📦 Товары", callback_data="admin_products")],
+    [InlineKeyboardButton(text="📁 Категории", callback_data="admin_categories")],
+    [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")]
+])
+
+ADMIN_BACK_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
+])
+
+# Static admin prompts, hoisted so the hot handlers just pass a reference
+ADMIN_CATEGORIES_TEXT = "📁 <b>Категории</b>\n\n<blockquote>Управление категориями товаров:</blockquote>"
+ADD_CATEGORY_PROMPT = "📁 <b>Новая категория</b>\n\n<blockquote>Введите название категории:</blockquote>"
+ADMIN_PRODUCTS_TEXT = "📦 <b>Товары</b>\n\n<blockquote>Выберите категорию для просмотра товаров:</blockquote>"
+ADD_PRODUCT_CATEGORY_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Выберите категорию для товара:</blockquote>"
+ADD_PRODUCT_NAME_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Введите название товара:</blockquote>"
+ADD_PRODUCT_DESC_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Введите описание товара:</blockquote>"
+ADD_PRODUCT_PRICE_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Введите цену в USD:</blockquote>"
+ADD_PRODUCT_TYPE_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Выберите тип товара:</blockquote>"
+ADD_PRODUCT_CONTENT_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Введите текстовый контент товара (данные, ключи, инструкции и т.д.):</blockquote>"
+ADD_PRODUCT_FILE_PROMPT = "📦 <b>Новый товар</b>\n\n<blockquote>Отправьте файл товара:</blockquote>"
+EDIT_SHOP_INFO_PROMPT = "📝 <b>Описание магазина</b>\n\n<blockquote>Введите новое описание магазина:</blockquote>"
+
+PRODUCT_TYPE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📝 Текстовый", callback_data="prodtype_text")],
+    [InlineKeyboardButton(text="📎 Файловый", callback_data="prodtype_file")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
+])
+
+
 def main_keyboard():
-    return ReplyKeyboardMarkup(keyboard=[
-        [KeyboardButton(text="🛒 Купить"), KeyboardButton(text="👤 Мой профиль")],
-        [KeyboardButton(text="🏬 О шопе"), KeyboardButton(text="🛟 Поддержка")]
-    ], resize_keyboard=True)
+    return MAIN_KB
 
 
+@functools.lru_cache(maxsize=64)
 def back_button(callback_data: str = "main"):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data=callback_data)]
@@ -318,35 +476,36 @@ def back_button(callback_data: str = "main"):
 
 
 def admin_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🖼 Медиа", callback_data="admin_media")],
-        [InlineKeyboardButton(text="📨 Рассылка", callback_data="admin_broadcast")],
-        [InlineKeyboardButton(text="📦 Товары", callback_data="admin_products")],
-        [InlineKeyboardButton(text="📁 Категории", callback_data="admin_categories")],
-        [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")]
-    ])
+    return ADMIN_KB
 
 
 def admin_back():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
-    ])
+    return ADMIN_BACK_KB
 
 
 # ==================== Helper Functions ====================
+def _tail_int(data: str):
+    # "delcat_7" (or a bare "7" tail from the dispatcher) -> 7 without the
+    # intermediate list a split() would allocate; returns None for tampered
+    # callback_data instead of raising
+    _, _, rest = data.rpartition("_")
+    return int(rest) if rest.isdigit() else None
+
+
+SENDERS = {
+    "photo": bot.send_photo,
+    "video": bot.send_video,
+    "animation": bot.send_animation,
+}
+
+
 async def send_with_media(chat_id: int, text: str, media_key: str, reply_markup=None):
     media = await get_media(media_key)
-    if media:
-        if media["media_type"] == "photo":
-            await bot.send_photo(chat_id, media["file_id"], caption=text, parse_mode="HTML", reply_markup=reply_markup)
-        elif media["media_type"] == "video":
-            await bot.send_video(chat_id, media["file_id"], caption=text, parse_mode="HTML", reply_markup=reply_markup)
-        elif media["media_type"] == "animation":
-            await bot.send_animation(chat_id, media["file_id"], caption=text, parse_mode="HTML",
-                                     reply_markup=reply_markup)
+    sender = SENDERS.get(media.media_type) if media else None
+    if sender:
+        await sender(chat_id, media.file_id, caption=text, reply_markup=reply_markup)
     else:
-        await bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=reply_markup)
+        await bot.send_message(chat_id, text, reply_markup=reply_markup)
 
 
 async def set_commands(user_id: int):
@@ -363,15 +522,13 @@ async def cmd_start(message: types.Message, state: FSMContext):
     await add_user(message.from_user)
     await set_commands(message.from_user.id)
     text = f"🏪 <b>{SHOP_NAME}</b>\n\n<blockquote>👇 Выберите действие:</blockquote>"
-    await message.answer(text, parse_mode="HTML", reply_markup=main_keyboard())
+    await message.answer(text, reply_markup=main_keyboard())
 
 
-@router.message(Command("admin"))
+@admin_router.message(Command("admin"))
 async def cmd_admin(message: types.Message, state: FSMContext):
-    if message.from_user.id not in ADMIN_IDS:
-        return
     await state.clear()
-    await message.answer("<blockquote>🎩 <b>Админ панель</b></blockquote>", parse_mode="HTML",
+    await message.answer("<blockquote>🎩 <b>Админ панель</b></blockquote>",
                          reply_markup=admin_keyboard())
 
 
@@ -380,10 +537,15 @@ async def cb_main(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     text = f"🏪 <b>{SHOP_NAME}</b>\n\n<blockquote>👇 Выберите действие:</blockquote>"
     try:
-        await callback.message.delete()
-    except:
-        pass
-    await bot.send_message(callback.from_user.id, text, parse_mode="HTML", reply_markup=main_keyboard())
+        # One editMessageText instead of deleteMessage + sendMessage; the main
+        # reply keyboard is still attached to the chat since /start
+        await callback.message.edit_text(text)
+    except TelegramBadRequest:
+        try:
+            await callback.message.delete()
+        except TelegramBadRequest:
+            pass
+        await bot.send_message(callback.from_user.id, text, reply_markup=main_keyboard())
     await callback.answer()
 
 
@@ -406,25 +568,27 @@ async def text_shop(message: types.Message):
 
 @router.message(F.text == "👤 Мой профиль")
 async def text_profile(message: types.Message):
-    user = await get_user(message.from_user.id)
-    purchases = await get_user_purchases(message.from_user.id)
-
-    text = f"👤 <b>Мой профиль</b>\n\n"
-    text += f"🆔 <b>ID:</b> <code>{message.from_user.id}</code>\n"
-    text += f"🛒 <b>Покупок:</b> {user['total_purchases']}\n"
-    text += f"💵 <b>Потрачено:</b> ${user['total_spent']:.2f}\n"
-    text += f"📅 <b>Регистрация:</b> {user['registered_at'][:10]}\n"
-
+    uid = message.from_user.id
+    user = await get_user(uid)
+    purchases = await get_user_purchases(uid)
+
+    parts = [
+        "👤 <b>Мой профиль</b>\n\n",
+        f"🆔 <b>ID:</b> <code>{uid}</code>\n",
+        f"🛒 <b>Покупок:</b> {user.total_purchases}\n",
+        f"💵 <b>Потрачено:</b> ${user.total_spent:.2f}\n",
+        f"📅 <b>Регистрация:</b> {user.registered_at[:10]}\n",
+    ]
     if purchases:
-        text += "\n<b>📋 Последние покупки:</b>\n"
-        for p in purchases[:5]:
-            text += f"• {p['product_name']} — ${p['price']}\n"
+        parts.append("\n<b>📋 Последние покупки:</b>\n")
+        parts.extend(f"• {p.product_name} — ${p.price}\n" for p in purchases[:5])
+    text = "".join(parts)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📜 Мои покупки", callback_data="my_purchases")]
     ])
 
-    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+    await message.answer(text, reply_markup=keyboard)
 
 
 @router.message(F.text == "🏬 О шопе")
@@ -459,14 +623,13 @@ async def cb_shop(callback: types.CallbackQuery):
     keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="main")])
 
     text = "🛒 <b>Каталог товаров</b>\n\n<blockquote>👇 Выберите категорию:</blockquote>"
-    await callback.message.edit_text(text, parse_mode="HTML",
+    await callback.message.edit_text(text,
                                      reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("cat_"))
-async def cb_category(callback: types.CallbackQuery):
-    cat_id = int(callback.data.split("_")[1])
+async def cb_category(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    cat_id = int(rest)
     products = await get_products_by_category(cat_id)
 
     if not products:
@@ -476,48 +639,56 @@ async def cb_category(callback: types.CallbackQuery):
     keyboard = []
     for prod in products:
         keyboard.append([InlineKeyboardButton(
-            text=f"📦 {prod['name']} — ${prod['price']}",
-            callback_data=f"prod_{prod['id']}"
+            text=f"📦 {prod.name} — ${prod.price}",
+            callback_data=f"prod_{prod.id}"
         )])
     keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="shop")])
 
     await callback.message.edit_text(
         "<blockquote>👇 Выберите товар:</blockquote>",
-        parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("prod_"))
-async def cb_product(callback: types.CallbackQuery):
-    prod_id = int(callback.data.split("_")[1])
+async def cb_product(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    prod_id = int(rest)
     product = await get_product(prod_id)
 
     if not product:
         await callback.answer("Товар не найден", show_alert=True)
         return
 
-    text = f"📦 <b>{product['name']}</b>\n\n"
-    text += f"<blockquote>{product['description']}</blockquote>\n\n"
-    text += f"💵 <b>Цена:</b> ${product['price']}"
+    text = (
+        f"📦 <b>{product.name}</b>\n\n"
+        f"<blockquote>{product.description}</blockquote>\n\n"
+        f"💵 <b>Цена:</b> ${product.price}"
+    )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Купить", callback_data=f"buy_{prod_id}")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data=f"cat_{product['category_id']}")]
+        [InlineKeyboardButton(text="◀️ Назад", callback_data=f"cat_{product.category_id}")]
     ])
 
+    # Edit in place when neither side involves media; fall back to the old
+    # delete + send path otherwise (media can't be swapped in via edit_text)
+    if callback.message.text is not None and await get_media(f"product_{prod_id}") is None:
+        try:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+            await callback.answer()
+            return
+        except TelegramBadRequest:
+            pass
     try:
         await callback.message.delete()
-    except:
+    except TelegramBadRequest:
         pass
     await send_with_media(callback.from_user.id, text, f"product_{prod_id}", keyboard)
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("buy_"))
-async def cb_buy(callback: types.CallbackQuery):
-    prod_id = int(callback.data.split("_")[1])
+async def cb_buy(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    prod_id = int(rest)
     product = await get_product(prod_id)
 
     if not product:
@@ -525,17 +696,18 @@ async def cb_buy(callback: types.CallbackQuery):
         return
 
     # Create CryptoBot invoice
+    uid = callback.from_user.id
     invoice = await create_invoice(
-        amount=product['price'],
-        description=f"Покупка: {product['name']}",
-        payload=f"{callback.from_user.id}:{prod_id}"
+        amount=product.price,
+        description=f"Покупка: {product.name}",
+        payload=f"{uid}:{prod_id}"
     )
 
     if not invoice:
         await callback.answer("Ошибка создания платежа. Попробуйте позже.", show_alert=True)
         return
 
-    await save_payment(callback.from_user.id, prod_id, str(invoice['invoice_id']), product['price'])
+    await save_payment(uid, prod_id, str(invoice['invoice_id']), product.price)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить", url=invoice['pay_url'])],
@@ -543,18 +715,77 @@ async def cb_buy(callback: types.CallbackQuery):
         [InlineKeyboardButton(text="◀️ Отмена", callback_data=f"prod_{prod_id}")]
     ])
 
-    text = f"💳 <b>Оплата товара</b>\n\n"
-    text += f"📦 <b>Товар:</b> {product['name']}\n"
-    text += f"💵 <b>Сумма:</b> ${product['price']} USDT\n\n"
-    text += "<blockquote>Нажмите кнопку «Оплатить» и после оплаты нажмите «Проверить оплату»</blockquote>"
+    text = (
+        "💳 <b>Оплата товара</b>\n\n"
+        f"📦 <b>Товар:</b> {product.name}\n"
+        f"💵 <b>Сумма:</b> ${product.price} USDT\n\n"
+        "<blockquote>Нажмите кнопку «Оплатить» и после оплаты нажмите «Проверить оплату»</blockquote>"
+    )
 
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("check_"))
-async def cb_check_payment(callback: types.CallbackQuery):
-    invoice_id = callback.data.split("_")[1]
+async def finalize_paid_invoice(invoice_id: str):
+    """Deliver the product for a paid invoice. Returns True if the payment was
+    still pending and has now been fulfilled."""
+    if not await claim_pending_payment(invoice_id):
+        return False
+
+    payment = await get_payment(invoice_id)
+    product = await get_product(payment.product_id)
+    await add_purchase(payment.user_id, payment.product_id, payment.amount)
+
+    # Send product to user
+    text = f"✅ <b>Оплата успешна!</b>\n\n📦 <b>Товар:</b> {product.name}\n\n"
+
+    if product.product_type == 'text':
+        text += f"<blockquote>{product.content}</blockquote>"
+        await bot.send_message(payment.user_id, text, reply_markup=back_button("shop"))
+    else:
+        await bot.send_message(payment.user_id, text)
+        await bot.send_document(payment.user_id, product.file_id,
+                                caption="📎 Ваш товар", reply_markup=back_button("shop"))
+
+    # Notify admins concurrently, without holding up the buyer
+    buyer = await get_user(payment.user_id)
+    notify = (
+        f"💰 <b>Новая покупка!</b>\n\n"
+        f"👤 Покупатель: @{(buyer.username if buyer else None) or 'Без юзернейма'}\n"
+        f"📦 Товар: {product.name}\n"
+        f"💵 Сумма: ${payment.amount}"
+    )
+    asyncio.create_task(asyncio.gather(
+        *(bot.send_message(admin_id, notify) for admin_id in ADMIN_IDS),
+        return_exceptions=True
+    ))
+    return True
+
+
+async def payment_poller():
+    # One getInvoices call covers every recent pending invoice, so payments are
+    # delivered without the user pressing the check button at all.
+    while True:
+        try:
+            rows = await DB.execute_fetchall(
+                "SELECT invoice_id FROM payments WHERE status = 'pending' AND created_at > datetime('now', '-1 hour')")
+            if rows:
+                params = {"invoice_ids": ",".join(row[0] for row in rows)}
+                async with HTTP.get("https://pay.crypt.bot/api/getInvoices", params=params) as resp:
+                    result = await resp.json()
+                if result.get("ok"):
+                    for inv in result["result"]["items"]:
+                        if inv["status"] == "paid":
+                            await finalize_paid_invoice(str(inv["invoice_id"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("payment poller iteration failed")
+        await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+
+
+async def cb_check_payment(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    invoice_id = rest
     invoice = await check_invoice(invoice_id)
 
     if not invoice:
@@ -562,35 +793,12 @@ async def cb_check_payment(callback: types.CallbackQuery):
         return
 
     if invoice['status'] == 'paid':
-        payment = await get_payment(invoice_id)
-        if payment and payment['status'] == 'pending':
-            await update_payment_status(invoice_id, 'paid')
-            product = await get_product(payment['product_id'])
-            await add_purchase(callback.from_user.id, payment['product_id'], payment['amount'])
-
-            # Send product to user
-            text = f"✅ <b>Оплата успешна!</b>\n\n📦 <b>Товар:</b> {product['name']}\n\n"
-
-            if product['product_type'] == 'text':
-                text += f"<blockquote>{product['content']}</blockquote>"
-                await callback.message.edit_text(text, parse_mode="HTML", reply_markup=back_button("shop"))
-            else:
-                await callback.message.edit_text(text, parse_mode="HTML")
-                await bot.send_document(callback.from_user.id, product['file_id'],
-                                        caption="📎 Ваш товар", reply_markup=back_button("shop"))
-
-            # Notify admins
-            for admin_id in ADMIN_IDS:
-                try:
-                    await bot.send_message(admin_id,
-                                           f"💰 <b>Новая покупка!</b>\n\n"
-                                           f"👤 Покупатель: @{callback.from_user.username or 'Без юзернейма'}\n"
-                                           f"📦 Товар: {product['name']}\n"
-                                           f"💵 Сумма: ${payment['amount']}",
-                                           parse_mode="HTML"
-                                           )
-                except:
-                    pass
+        if await finalize_paid_invoice(invoice_id):
+            try:
+                await callback.message.delete()
+            except TelegramBadRequest:
+                pass  # invoice message already gone
+            await callback.answer()
         else:
             await callback.answer("Товар уже выдан!", show_alert=True)
     else:
@@ -607,51 +815,43 @@ async def cb_my_purchases(callback: types.CallbackQuery):
         await callback.answer("У вас пока нет покупок", show_alert=True)
         return
 
-    text = "📜 <b>Мои покупки</b>\n\n"
-    for p in purchases:
-        text += f"📦 {p['product_name']} — ${p['price']} ({p['purchased_at'][:10]})\n"
+    parts = ["📜 <b>Мои покупки</b>\n\n"]
+    parts.extend(f"📦 {p.product_name} — ${p.price} ({p.purchased_at[:10]})\n" for p in purchases)
 
-    await callback.message.edit_text(text, parse_mode="HTML")
+    await callback.message.edit_text("".join(parts))
     await callback.answer()
 
 
 # ==================== Admin Handlers ====================
-@router.callback_query(F.data == "admin_panel")
+@admin_router.callback_query(F.data == "admin_panel")
 async def cb_admin_panel(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
     await state.clear()
     await callback.message.edit_text(
         "<blockquote>🎩 <b>Админ панель</b></blockquote>",
-        parse_mode="HTML",
         reply_markup=admin_keyboard()
     )
     await callback.answer()
 
 
-@router.callback_query(F.data == "admin_stats")
+@admin_router.callback_query(F.data == "admin_stats")
 async def cb_admin_stats(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     users, purchases, revenue, products = await get_stats()
 
-    text = "📊 <b>Статистика</b>\n\n"
-    text += f"👥 <b>Пользователей:</b> {users}\n"
-    text += f"🛒 <b>Покупок:</b> {purchases}\n"
-    text += f"💵 <b>Выручка:</b> ${revenue:.2f}\n"
-    text += f"📦 <b>Товаров:</b> {products}"
+    text = (
+        "📊 <b>Статистика</b>\n\n"
+        f"👥 <b>Пользователей:</b> {users}\n"
+        f"🛒 <b>Покупок:</b> {purchases}\n"
+        f"💵 <b>Выручка:</b> ${revenue:.2f}\n"
+        f"📦 <b>Товаров:</b> {products}"
+    )
 
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=admin_back())
+    await callback.message.edit_text(text, reply_markup=admin_back())
     await callback.answer()
 
 
 # ==================== Admin Media ====================
-@router.callback_query(F.data == "admin_media")
+@admin_router.callback_query(F.data == "admin_media")
 async def cb_admin_media(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 Главное меню", callback_data="setmedia_main_menu")],
         [InlineKeyboardButton(text="🛒 Меню магазина", callback_data="setmedia_shop_menu")],
@@ -662,18 +862,13 @@ async def cb_admin_media(callback: types.CallbackQuery):
 
     await callback.message.edit_text(
         "🖼 <b>Настройка медиа</b>\n\n<blockquote>Выберите раздел для установки медиа:</blockquote>",
-        parse_mode="HTML",
         reply_markup=keyboard
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("setmedia_"))
-async def cb_setmedia(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
-    media_key = callback.data.replace("setmedia_", "")
+async def cb_setmedia(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    media_key = rest
     await state.update_data(media_key=media_key)
     await state.set_state(AdminStates.set_media_file)
 
@@ -684,28 +879,24 @@ async def cb_setmedia(callback: types.CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         "🖼 <b>Установка медиа</b>\n\n<blockquote>Отправьте фото, видео или GIF для этого раздела:</blockquote>",
-        parse_mode="HTML",
         reply_markup=keyboard
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("delmedia_"))
-async def cb_delmedia(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
-    media_key = callback.data.replace("delmedia_", "")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('DELETE FROM media_settings WHERE key = ?', (media_key,))
-        await db.commit()
+async def cb_delmedia(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    media_key = rest
+    async with DB_LOCK:
+        await DB.execute('DELETE FROM media_settings WHERE key = ?', (media_key,))
+        await DB.commit()
+    _cache_drop(('media', media_key))
 
     await state.clear()
     await callback.answer("✅ Медиа удалено", show_alert=True)
     await cb_admin_media(callback)
 
 
-@router.message(AdminStates.set_media_file,
+@admin_router.message(AdminStates.set_media_file,
                 F.content_type.in_([ContentType.PHOTO, ContentType.VIDEO, ContentType.ANIMATION]))
 async def process_media_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -726,15 +917,12 @@ async def process_media_file(message: types.Message, state: FSMContext):
 
     await set_media(media_key, media_type, file_id)
     await state.clear()
-    await message.answer("✅ Медиа успешно установлено!", parse_mode="HTML", reply_markup=admin_back())
+    await message.answer("✅ Медиа успешно установлено!", reply_markup=admin_back())
 
 
 # ==================== Admin Broadcast ====================
-@router.callback_query(F.data == "admin_broadcast")
+@admin_router.callback_query(F.data == "admin_broadcast")
 async def cb_admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     await state.set_state(AdminStates.broadcast_text)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -743,162 +931,199 @@ async def cb_admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         "📨 <b>Рассылка</b>\n\n<blockquote>Отправьте текст, фото, видео или GIF для рассылки:</blockquote>",
-        parse_mode="HTML",
         reply_markup=keyboard
     )
     await callback.answer()
 
 
-@router.message(AdminStates.broadcast_text)
+@admin_router.message(AdminStates.broadcast_text)
 async def process_broadcast(message: types.Message, state: FSMContext):
     await state.clear()
-    users = await get_all_users()
 
-    success = 0
-    failed = 0
+    if not (message.photo or message.video or message.animation or message.text):
+        await message.answer("❌ Такой тип контента не поддерживается для рассылки",
+                             reply_markup=admin_back())
+        return
 
     status_msg = await message.answer("📤 Рассылка начата...")
 
-    for user_id in users:
-        try:
-            if message.photo:
-                await bot.send_photo(user_id, message.photo[-1].file_id,
-                                     caption=message.caption, parse_mode="HTML")
-            elif message.video:
-                await bot.send_video(user_id, message.video.file_id,
-                                     caption=message.caption, parse_mode="HTML")
-            elif message.animation:
-                await bot.send_animation(user_id, message.animation.file_id,
-                                         caption=message.caption, parse_mode="HTML")
-            else:
-                await bot.send_message(user_id, message.text, parse_mode="HTML")
-            success += 1
-        except:
-            failed += 1
-        await asyncio.sleep(0.05)
+    slot_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    next_slot = loop.time()
+    success = 0
+    failed = 0
+
+    async def _wait_slot():
+        # Token-bucket pacing: hand out send slots BROADCAST_RATE per second
+        nonlocal next_slot
+        async with slot_lock:
+            now = loop.time()
+            slot = max(now, next_slot)
+            next_slot = slot + 1.0 / BROADCAST_RATE
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # Bind the send call once: the source message is the same for every
+    # recipient, so the type dispatch doesn't belong inside the loop
+    if message.photo:
+        send = functools.partial(bot.send_photo, photo=message.photo[-1].file_id,
+                                 caption=message.caption)
+    elif message.video:
+        send = functools.partial(bot.send_video, video=message.video.file_id,
+                                 caption=message.caption)
+    elif message.animation:
+        send = functools.partial(bot.send_animation, animation=message.animation.file_id,
+                                 caption=message.caption)
+    else:
+        send = functools.partial(bot.send_message, text=message.text)
+
+    async def _send_one(user_id):
+        nonlocal success, failed
+        while True:
+            await _wait_slot()
+            try:
+                await send(user_id)
+                success += 1
+            except TelegramRetryAfter as e:
+                # Rate-limited: honour Telegram's backoff, then retry this user
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                # User blocked the bot: count the failure and remember it so
+                # the next broadcast doesn't pay this round-trip again
+                failed += 1
+                asyncio.create_task(mark_blocked(user_id))
+            except TelegramAPIError:
+                failed += 1
+            except Exception:
+                # A non-Telegram error must not kill the worker: the producer
+                # would block forever on a full queue with no one draining it
+                logging.exception("broadcast send to %s failed", user_id)
+                failed += 1
+            return
+
+    async def _worker():
+        while True:
+            user_id = await queue.get()
+            try:
+                if user_id is None:
+                    return
+                await _send_one(user_id)
+            finally:
+                queue.task_done()
+
+    # Recipients stream straight from the DB cursor into the workers, so the
+    # first sends go out while the query is still producing rows.
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+    workers = [asyncio.create_task(_worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    async for user_id in iter_all_users():
+        await queue.put(user_id)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
 
     await status_msg.edit_text(
         f"✅ <b>Рассылка завершена!</b>\n\n"
         f"📤 Успешно: {success}\n"
         f"❌ Ошибок: {failed}",
-        parse_mode="HTML",
         reply_markup=admin_back()
     )
 
 
 # ==================== Admin Categories ====================
-@router.callback_query(F.data == "admin_categories")
+@admin_router.callback_query(F.data == "admin_categories")
 async def cb_admin_categories(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     categories = await get_categories()
 
-    keyboard = []
-    for cat in categories:
-        keyboard.append([
-            InlineKeyboardButton(text=f"📂 {cat['name']}", callback_data=f"editcat_{cat['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"delcat_{cat['id']}")
-        ])
-    keyboard.append([InlineKeyboardButton(text="➕ Добавить категорию", callback_data="addcat")])
-    keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")])
+    IKB = InlineKeyboardButton
+    keyboard = [[IKB(text=f"📂 {cat['name']}", callback_data=f"editcat_{cat['id']}"),
+                 IKB(text="🗑", callback_data=f"delcat_{cat['id']}")] for cat in categories]
+    keyboard.append([IKB(text="➕ Добавить категорию", callback_data="addcat")])
+    keyboard.append([IKB(text="◀️ Назад", callback_data="admin_panel")])
 
     await callback.message.edit_text(
-        "📁 <b>Категории</b>\n\n<blockquote>Управление категориями товаров:</blockquote>",
-        parse_mode="HTML",
+        ADMIN_CATEGORIES_TEXT,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
 
-@router.callback_query(F.data == "addcat")
+@admin_router.callback_query(F.data == "addcat")
 async def cb_addcat(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     await state.set_state(AdminStates.add_category_name)
 
     await callback.message.edit_text(
-        "📁 <b>Новая категория</b>\n\n<blockquote>Введите название категории:</blockquote>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_categories")]
-        ])
+        ADD_CATEGORY_PROMPT,
+        reply_markup=back_button("admin_categories")
     )
     await callback.answer()
 
 
-@router.message(AdminStates.add_category_name)
+@admin_router.message(AdminStates.add_category_name)
 async def process_category_name(message: types.Message, state: FSMContext):
     await add_category(message.text)
     await state.clear()
     await message.answer("✅ Категория добавлена!", reply_markup=admin_back())
 
 
-@router.callback_query(F.data.startswith("delcat_"))
-async def cb_delcat(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+async def cb_delcat(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    cat_id = _tail_int(rest)
+    if cat_id is None:
         return
-
-    cat_id = int(callback.data.split("_")[1])
+    categories = await get_categories()
     await delete_category(cat_id)
+
+    # Patch the keyboard in place: one editMessageReplyMarkup instead of a
+    # category re-read plus a full editMessageText re-render
+    IKB = InlineKeyboardButton
+    keyboard = [[IKB(text=f"📂 {cat['name']}", callback_data=f"editcat_{cat['id']}"),
+                 IKB(text="🗑", callback_data=f"delcat_{cat['id']}")]
+                for cat in categories if cat['id'] != cat_id]
+    keyboard.append([IKB(text="➕ Добавить категорию", callback_data="addcat")])
+    keyboard.append([IKB(text="◀️ Назад", callback_data="admin_panel")])
+    await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
     await callback.answer("✅ Категория удалена", show_alert=True)
-    await cb_admin_categories(callback)
 
 
 # ==================== Admin Products ====================
-@router.callback_query(F.data == "admin_products")
+@admin_router.callback_query(F.data == "admin_products")
 async def cb_admin_products(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     categories = await get_categories()
 
-    keyboard = []
-    for cat in categories:
-        keyboard.append([InlineKeyboardButton(text=f"📂 {cat['name']}", callback_data=f"admincat_{cat['id']}")])
-    keyboard.append([InlineKeyboardButton(text="➕ Добавить товар", callback_data="addprod")])
-    keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")])
+    IKB = InlineKeyboardButton
+    keyboard = [[IKB(text=f"📂 {cat['name']}", callback_data=f"admincat_{cat['id']}")] for cat in categories]
+    keyboard.append([IKB(text="➕ Добавить товар", callback_data="addprod")])
+    keyboard.append([IKB(text="◀️ Назад", callback_data="admin_panel")])
 
     await callback.message.edit_text(
-        "📦 <b>Товары</b>\n\n<blockquote>Выберите категорию для просмотра товаров:</blockquote>",
-        parse_mode="HTML",
+        ADMIN_PRODUCTS_TEXT,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("admincat_"))
-async def cb_admincat(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+async def cb_admincat(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    cat_id = _tail_int(rest)
+    if cat_id is None:
         return
-
-    cat_id = int(callback.data.split("_")[1])
     products = await get_products_by_category(cat_id)
 
-    keyboard = []
-    for prod in products:
-        keyboard.append([
-            InlineKeyboardButton(text=f"📦 {prod['name']} — ${prod['price']}", callback_data=f"viewprod_{prod['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"delprod_{prod['id']}")
-        ])
-    keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_products")])
+    IKB = InlineKeyboardButton
+    keyboard = [[IKB(text=f"📦 {prod.name} — ${prod.price}", callback_data=f"viewprod_{prod.id}"),
+                 IKB(text="🗑", callback_data=f"delprod_{prod.id}")] for prod in products]
+    keyboard.append([IKB(text="◀️ Назад", callback_data="admin_products")])
 
     await callback.message.edit_text(
         "<blockquote>📦 Товары в категории:</blockquote>",
-        parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("delprod_"))
-async def cb_delprod(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+async def cb_delprod(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    prod_id = _tail_int(rest)
+    if prod_id is None:
         return
-
-    prod_id = int(callback.data.split("_")[1])
-    product = await get_product(prod_id)
     await delete_product(prod_id)
     await callback.answer("✅ Товар удален", show_alert=True)
 
@@ -910,125 +1135,93 @@ async def cb_delprod(callback: types.CallbackQuery):
 
 
 # ==================== Add Product Flow ====================
-@router.callback_query(F.data == "addprod")
+@admin_router.callback_query(F.data == "addprod")
 async def cb_addprod(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     categories = await get_categories()
     if not categories:
         await callback.answer("Сначала создайте категорию!", show_alert=True)
         return
 
-    keyboard = []
-    for cat in categories:
-        keyboard.append([InlineKeyboardButton(text=f"📂 {cat['name']}", callback_data=f"newprodcat_{cat['id']}")])
-    keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_products")])
+    IKB = InlineKeyboardButton
+    keyboard = [[IKB(text=f"📂 {cat['name']}", callback_data=f"newprodcat_{cat['id']}")] for cat in categories]
+    keyboard.append([IKB(text="◀️ Назад", callback_data="admin_products")])
 
     await callback.message.edit_text(
-        "📦 <b>Новый товар</b>\n\n<blockquote>Выберите категорию для товара:</blockquote>",
-        parse_mode="HTML",
+        ADD_PRODUCT_CATEGORY_PROMPT,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("newprodcat_"))
-async def cb_newprodcat(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
+async def cb_newprodcat(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    cat_id = _tail_int(rest)
+    if cat_id is None:
         return
-
-    cat_id = int(callback.data.split("_")[1])
     await state.update_data(category_id=cat_id)
     await state.set_state(AdminStates.add_product_name)
 
     await callback.message.edit_text(
-        "📦 <b>Новый товар</b>\n\n<blockquote>Введите название товара:</blockquote>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-        ])
+        ADD_PRODUCT_NAME_PROMPT,
+        reply_markup=back_button("addprod")
     )
     await callback.answer()
 
 
-@router.message(AdminStates.add_product_name)
+async def _advance(message, state, next_state, prompt, reply_markup=None, **data):
+    # One place for the update_data/set_state/prompt triple every add-product
+    # step repeats; the storage write and the prompt send happen back to back
+    await state.update_data(**data)
+    await state.set_state(next_state)
+    await message.answer(prompt, reply_markup=reply_markup or back_button("addprod"))
+
+
+_PRICE_RE = re.compile(r"^\d+[.,]?\d*$")
+
+
+@admin_router.message(AdminStates.add_product_name)
 async def process_product_name(message: types.Message, state: FSMContext):
-    await state.update_data(name=message.text)
-    await state.set_state(AdminStates.add_product_desc)
-
-    await message.answer(
-        "📦 <b>Новый товар</b>\n\n<blockquote>Введите описание товара:</blockquote>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-        ])
-    )
+    await _advance(message, state, AdminStates.add_product_desc, ADD_PRODUCT_DESC_PROMPT,
+                   name=message.text)
 
 
-@router.message(AdminStates.add_product_desc)
+@admin_router.message(AdminStates.add_product_desc)
 async def process_product_desc(message: types.Message, state: FSMContext):
-    await state.update_data(description=message.text)
-    await state.set_state(AdminStates.add_product_price)
-
-    await message.answer(
-        "📦 <b>Новый товар</b>\n\n<blockquote>Введите цену в USD:</blockquote>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-        ])
-    )
+    await _advance(message, state, AdminStates.add_product_price, ADD_PRODUCT_PRICE_PROMPT,
+                   description=message.text)
 
 
-@router.message(AdminStates.add_product_price)
+@admin_router.message(AdminStates.add_product_price)
 async def process_product_price(message: types.Message, state: FSMContext):
-    try:
-        price = float(message.text.replace(",", "."))
-        await state.update_data(price=price)
-        await state.set_state(AdminStates.add_product_type)
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📝 Текстовый", callback_data="prodtype_text")],
-            [InlineKeyboardButton(text="📎 Файловый", callback_data="prodtype_file")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-        ])
-
-        await message.answer(
-            "📦 <b>Новый товар</b>\n\n<blockquote>Выберите тип товара:</blockquote>",
-            parse_mode="HTML",
-            reply_markup=keyboard
-        )
-    except ValueError:
+    if not _PRICE_RE.match(message.text or ""):
         await message.answer("❌ Введите корректную цену (число)")
+        return
+    await _advance(message, state, AdminStates.add_product_type, ADD_PRODUCT_TYPE_PROMPT,
+                   reply_markup=PRODUCT_TYPE_KB, price=float(message.text.replace(",", ".")))
 
 
-@router.callback_query(F.data.startswith("prodtype_"), AdminStates.add_product_type)
-async def cb_prodtype(callback: types.CallbackQuery, state: FSMContext):
-    prod_type = callback.data.split("_")[1]
+async def cb_prodtype(callback: types.CallbackQuery, rest: str, state: FSMContext):
+    # the state filter moved here when this handler joined the dispatch table
+    if await state.get_state() != AdminStates.add_product_type.state:
+        return
+    prod_type = rest
     await state.update_data(product_type=prod_type)
 
     if prod_type == "text":
         await state.set_state(AdminStates.add_product_content)
         await callback.message.edit_text(
-            "📦 <b>Новый товар</b>\n\n<blockquote>Введите текстовый контент товара (данные, ключи, инструкции и т.д.):</blockquote>",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-            ])
+            ADD_PRODUCT_CONTENT_PROMPT,
+            reply_markup=back_button("addprod")
         )
     else:
         await state.set_state(AdminStates.add_product_file)
         await callback.message.edit_text(
-            "📦 <b>Новый товар</b>\n\n<blockquote>Отправьте файл товара:</blockquote>",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="addprod")]
-            ])
+            ADD_PRODUCT_FILE_PROMPT,
+            reply_markup=back_button("addprod")
         )
     await callback.answer()
 
 
-@router.message(AdminStates.add_product_content)
+@admin_router.message(AdminStates.add_product_content)
 async def process_product_content(message: types.Message, state: FSMContext):
     data = await state.get_data()
     await add_product(
@@ -1043,7 +1236,7 @@ async def process_product_content(message: types.Message, state: FSMContext):
     await message.answer("✅ Товар успешно добавлен!", reply_markup=admin_back())
 
 
-@router.message(AdminStates.add_product_file, F.document)
+@admin_router.message(AdminStates.add_product_file, F.document)
 async def process_product_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
     await add_product(
@@ -1059,11 +1252,8 @@ async def process_product_file(message: types.Message, state: FSMContext):
 
 
 # ==================== Admin Settings ====================
-@router.callback_query(F.data == "admin_settings")
+@admin_router.callback_query(F.data == "admin_settings")
 async def cb_admin_settings(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📝 Изменить описание магазина", callback_data="edit_shop_info")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
@@ -1071,30 +1261,23 @@ async def cb_admin_settings(callback: types.CallbackQuery):
 
     await callback.message.edit_text(
         "⚙️ <b>Настройки</b>",
-        parse_mode="HTML",
         reply_markup=keyboard
     )
     await callback.answer()
 
 
-@router.callback_query(F.data == "edit_shop_info")
+@admin_router.callback_query(F.data == "edit_shop_info")
 async def cb_edit_shop_info(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        return
-
     await state.set_state(AdminStates.edit_shop_info)
 
     await callback.message.edit_text(
-        "📝 <b>Описание магазина</b>\n\n<blockquote>Введите новое описание магазина:</blockquote>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_settings")]
-        ])
+        EDIT_SHOP_INFO_PROMPT,
+        reply_markup=back_button("admin_settings")
     )
     await callback.answer()
 
 
-@router.message(AdminStates.edit_shop_info)
+@admin_router.message(AdminStates.edit_shop_info)
 async def process_shop_info(message: types.Message, state: FSMContext):
     await set_shop_setting("shop_info", message.text)
     await state.clear()
@@ -1102,23 +1285,67 @@ async def process_shop_info(message: types.Message, state: FSMContext):
 
 
 # ==================== Cancel State Handler ====================
+# ~StateFilter(None) keeps this handler out of dispatch entirely for the
+# common case of a nav click with no FSM state to clear
 @router.callback_query(
-    F.data.in_(["admin_panel", "admin_media", "admin_categories", "admin_products", "addprod", "admin_settings"]))
+    F.data.in_(["admin_panel", "admin_media", "admin_categories", "admin_products", "addprod", "admin_settings"]),
+    ~StateFilter(None))
 async def cancel_state(callback: types.CallbackQuery, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state:
-        await state.clear()
+    await state.clear()
+
+
+# ==================== Callback Dispatch ====================
+# Prefixed callbacks route through one dict lookup instead of a chain of
+# F.data.startswith filters evaluated per handler for every callback_query.
+CALLBACK_DISPATCH = {
+    "cat": cb_category,
+    "prod": cb_product,
+    "buy": cb_buy,
+    "check": cb_check_payment,
+}
+
+# Admin-only prefixes dispatch on admin_router, where the IsAdmin filter
+# already gates access; editcat_ buttons render but have no handler here.
+ADMIN_CALLBACK_DISPATCH = {
+    "delcat": cb_delcat,
+    "admincat": cb_admincat,
+    "delprod": cb_delprod,
+    "newprodcat": cb_newprodcat,
+    "prodtype": cb_prodtype,
+    "setmedia": cb_setmedia,
+    "delmedia": cb_delmedia,
+}
+
+
+@admin_router.callback_query(F.data.func(lambda d: d.partition("_")[0] in ADMIN_CALLBACK_DISPATCH))
+async def admin_cb_dispatch(callback: types.CallbackQuery, state: FSMContext):
+    prefix, _, rest = callback.data.partition("_")
+    await ADMIN_CALLBACK_DISPATCH[prefix](callback, rest, state)
+
+
+@router.callback_query(F.data.func(lambda d: d.partition("_")[0] in CALLBACK_DISPATCH))
+async def cb_dispatch(callback: types.CallbackQuery, state: FSMContext):
+    prefix, _, rest = callback.data.partition("_")
+    await CALLBACK_DISPATCH[prefix](callback, rest, state)
 
 
 # ==================== Main ====================
 async def main():
-    await init_db()
-    logging.basicConfig(level=logging.INFO)
-    print("\033[35m" + "═" * 40)
-    print("  🤖 Создатель бота: t.me/fuck_zaza")
-    print("═" * 40 + "\033[0m")
-    print("🚀 Бот запущен!")
-    await dp.start_polling(bot)
+    global BOT_USERNAME
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # DB init, the CryptoBot session and the getMe round trip are independent,
+    # so cold start costs max() of them rather than the sum
+    _, _, me = await asyncio.gather(init_db(), open_http(), bot.get_me())
+    BOT_USERNAME = me.username
+    asyncio.create_task(get_categories())  # prewarm the cache while polling starts
+    logging.info("🚀 Бот запущен!")
+    poller = asyncio.create_task(payment_poller())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        poller.cancel()
+        await HTTP.close()
+        await DB.close()
 
 
 if __name__ == "__main__":